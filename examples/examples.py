@@ -1,5 +1,6 @@
 import os
 import time
+from functools import lru_cache
 
 # Deactivate the decorator
 from metrit import metrit
@@ -61,12 +62,14 @@ def cpu_intensive(a: int = 1, b: int = 2) -> int:
 
 
 @metrit
+@lru_cache(maxsize=None)  # Memoized so each n is computed once, the recursion detection still applies
 def recursive_func(n):
     if n < 2:
         return n
     return recursive_func(n - 2) + recursive_func(n - 1)
 
 
+@lru_cache(maxsize=None)
 def fib(n):
     if n < 2:
         return n
@@ -81,10 +84,11 @@ def wrapped_recursive_func(n):
 @metrit()
 def simulate_writes_and_reads(num_writes=5_000, data_size=1024):
     file = ".temp_file"
+    chunk = b"a" * data_size
     with open(file, "wb") as f:
         for _ in range(num_writes):
-            f.write(b"a" * data_size)
-            f.flush()  # Ensure data is written to disk
+            f.write(chunk)
+        f.flush()  # Ensure data is written to disk once all the chunks are buffered
 
     with open(file, "rb") as f:
         f.read()
@@ -1,12 +1,18 @@
+import os
 import time
-from sys import platform
-from typing import Dict, Self
-
-from multiprocess import Process, Queue, current_process  # type: ignore
+from math import fsum
+from threading import Event, Thread
+from typing import Dict, List
 
 from .StatCollector import StatCollector
 from .Stats import RawStats, Stats
-from .utils import format_size
+from .utils import IS_MACOS, format_size
+
+BANNER: str = "*" * 5  # Surrounds the title and the end of the verbose output
+# Format of the concise output. It is picked once since the IO columns are not available on macOS
+SUMMARY_FORMAT: str = "Function {:30} {:>8} avg of memory {:>8.2f}% avg of CPU" + (
+    "" if IS_MACOS else " {:>8} IO reads {:>8} IO writes"
+)
 
 
 class Monitoring:
@@ -15,173 +21,184 @@ class Monitoring:
         Initializes a new instance of the Monitoring class.
 
         Args:
-            find_children (bool, optional): If True, the monitoring process will also monitor child processes spawned by the main process. Defaults to False.
+            find_children (bool, optional): If True, the monitoring will also monitor child processes spawned by the main process. Defaults to False.
 
         Returns:
             None
         """
-        self.pid: int = current_process().pid  # type: ignore
+        self.pid: int = os.getpid()  # Read at runtime instead of cached since isolated calls run in forked processes
         self.find_children: bool = find_children
         self.stat_collector: StatCollector = StatCollector(self.pid)
+        self.baseline_stats_per_pid: Dict[int, Stats] = {}
         self.stats_per_pid: Dict[int, Stats] = {}
         self.formated_stats: Stats = Stats()
 
-    @staticmethod
-    def has_process_crashed(queue: Queue) -> bool:
+    def has_process_crashed(self) -> bool:
         """
-        Checks if the process has crashed based on the given queue.
-
-        Args:
-            queue (Queue): The queue containing the process status.
+        Checks if the stats collection has failed at any point.
 
         Returns:
             bool: True if the process has crashed, False otherwise.
         """
-        while not queue.empty():
-            if not queue.get():
-                return True
-        return False
+        return self.stat_collector.has_crashed
 
     def take_snapshot(self):
         """
-        Takes a snapshot of RAM and IO stats for the process and its children.
-        Saves the result in `self.stats_per_pid` in the form of Dict[int, Stats].
+        Takes a snapshot of RAM and IO stats for the process and its children to use as the baseline of the monitoring.
+        Saves the result in `self.baseline_stats_per_pid` in the form of Dict[int, Stats].
+        The snapshot is a single read of the psutil counters so it is taken in the current process.
         """
+        raw_snapshot_stats: Dict[int, RawStats] = self.collect_snapshot_stats()
+        if self.has_process_crashed():
+            print("Process snapshot has crashed")
 
-        self.pre_success_queue = Queue()
-        self.pre_data_queue = Queue()
-
-        # Take a snapshot of RAM and IO stats for the process and its children
-        try:
-            take_snapshot_process: Process = Process(target=self.collect_snapshot_stats, args=())
-            take_snapshot_process.start()
-            take_snapshot_process.join()  # Ensure process termination
-            has_process_crashed: bool = self.has_process_crashed(self.pre_success_queue)
-            if has_process_crashed:
-                print("Process snapshot has crashed")
-                take_snapshot_process.terminate()
-            raw_snapshot_stats: Dict[int, RawStats] = self.pre_data_queue.get()
-
-        except Exception:
-            raw_snapshot_stats = {}  # Avoid hanging the process if something goes wrong
+        self.baseline_stats_per_pid = self.stat_collector.calculate_statistics_from_data(raw_snapshot_stats)
 
-        self.stats_per_pid: Dict[int, Stats] = self.stat_collector.calculate_statistics_from_data(raw_snapshot_stats)
-
-        # Clear queues
-        self.pre_data_queue.close()
-        self.pre_success_queue.close()
-        delattr(self, "pre_data_queue")
-        delattr(self, "pre_success_queue")
-
-    def collect_snapshot_stats(self):
+    def collect_snapshot_stats(self) -> Dict[int, RawStats]:
         """
         Collects CPU and RAM statistics for the process and its children, and IO counters.
-        The result is added to the queue.
-        It uses queues to pass the data:
-            pre_data_queue (Queue): A queue to store the collected statistics.
-            success_queue (Queue): A queue to communicate success or failure.
+
+        Returns:
+            Dict[int, RawStats]: The collected statistics as {pid: RawStats}.
         """
-        refresh_rate: float = 0.0
         raw_stats: Dict[int, RawStats] = {}
+        pids: List[int] = self.stat_collector.get_pids(self.find_children)
 
-        cpu_memory_stats = self.stat_collector.collect_cpu_ram_stats(
-            raw_stats, self.find_children, refresh_rate, self.pre_success_queue
-        )
-
-        raw_stats = self.stat_collector.collect_io_counters(
-            cpu_memory_stats, self.find_children, self.pre_success_queue
-        )
-
-        self.pre_data_queue.put(raw_stats)
+        return self.stat_collector.collect_stats(raw_stats, pids)
 
     def start_monitoring(self):
         """
-        Initializes the monitoring process by creating queues and starting the pooling process.
-        This function initializes the monitoring process by creating the necessary queues for communication between the main process and the pooling process.
+        Initializes the monitoring by creating the stop event and starting the pooling thread.
+        The pooling runs in a daemon thread of the current process, so no process has to be spawned for each call.
+        psutil releases the GIL while reading the process counters so the sampling does not block the monitored function.
         """
 
-        self.stop_queue = Queue()
-        self.data_pool_queue = Queue()
-        self.success_queue = Queue()
-        self.pooling_raw_stats: Dict | None = None
+        self.stat_collector.has_crashed = False  # A failed snapshot has already been reported
+        self.stop_event: Event = Event()
+        self.pooling_raw_stats: Dict[int, RawStats] = {}
+
+        # The CPU usage is measured since this read, so every sample only waits once for all the processes.
+        # It is read before starting the thread, which may not run until a short CPU-bound function has already returned
+        self.stat_collector.prime_cpu_percent(self.stat_collector.get_pids(self.find_children))
 
-        # Start the monitoring process
-        self.pooling_process = Process(target=self.pool_stats, args=())
-        self.pooling_process.start()
+        # Start the monitoring thread
+        self.pooling_thread: Thread = Thread(target=self.pool_stats, args=(), daemon=True)
+        self.pooling_thread.start()
 
     def stop_monitoring(self):
         """
-        Stops the monitoring process by sending a signal to stop the pooling process.
-        This function sends a signal to stop the pooling process by putting the string "STOP" into the `stop_queue`.
-        It then waits for the pooling process to terminate using the `join()` method.
-        If the pooling process has crashed, it prints a message and terminates the process using the `terminate()` method.
-        After that, it retrieves the raw statistics from the `data_pool_queue` and calculates the statistics per PID using the `calculate_statistics_from_data()` method of the `stat_collector` object.
+        Stops the monitoring by setting the stop event of the pooling thread.
+        It then waits for the pooling thread to finish using the `join()` method.
+        If the pooling has crashed, it prints a message.
+        After that, it calculates the statistics per PID from the raw statistics using the `calculate_statistics_from_data()` method of the `stat_collector` object.
         The object stats_per_pid is a dict of Stats objects, where the keys are the PIDs and the values are the corresponding Stats objects.
         """
-        # Send a signal to stop the pooling process
-        self.stop_queue.put("STOP")
-        self.pooling_process.join()  # type: ignore
-        has_process_crashed = self.has_process_crashed(self.success_queue)
-        if has_process_crashed:
+        # Send a signal to stop the pooling thread
+        self.stop_event.set()
+        self.pooling_thread.join()
+        if self.has_process_crashed():
             print("Process pooling has crashed")
-            self.pooling_process.terminate()  # type: ignore
 
-        pooling_raw_stats: Dict[int, RawStats] = self.data_pool_queue.get()
+        self.stats_per_pid = self.stat_collector.calculate_statistics_from_data(self.pooling_raw_stats)
 
-        self.stats_per_pid = self.stat_collector.calculate_statistics_from_data(pooling_raw_stats)
-
-        # Clean queues and process
-        self.stop_queue.close()
-        self.data_pool_queue.close()
-        self.success_queue.close()
-        delattr(self, "stop_queue")
-        delattr(self, "data_pool_queue")
-        delattr(self, "success_queue")
-        delattr(self, "pooling_process")
+        # Clean the thread and its synchronization objects so the instance can be pickled
+        delattr(self, "stop_event")
+        delattr(self, "pooling_raw_stats")
+        delattr(self, "pooling_thread")
 
     def pool_stats(self):
         """
         Collects statistics about CPU and RAM usage and IO counters for the process and its children.
-        It uses queues to pass the data:
-            data_pool_queue (Queue): A queue to store the collected statistics as a dict of RawStats.
-            stop_queue (Queue): A queue to receive stop signals.
-            success_queue (Queue): A queue to communicate success or failure.
+        It uses the following attributes to pass the data:
+            pooling_raw_stats (Dict[int, RawStats]): A dict to store the collected statistics.
+            stop_event (Event): An event to receive the stop signal.
+        A failed collection is reported through `self.stat_collector.has_crashed`.
         """
-        refresh_rate: float = 0.1  # Initial refresh rate
+        # Start small so short functions get real samples. The CPU usage is only read every `cpu_interval` seconds of the StatCollector
+        refresh_rate: float = 0.01  # Initial refresh rate
+        min_refresh_rate: float = refresh_rate  # Refresh rate used when the usage changes. It grows over time to bound the overhead
         max_refresh_rate: int = 5  # Maximum refresh rate
-        time_elapsed: float = 0.0
-        stats: Dict[int, RawStats] = {}
+        backoff_interval: int = 10  # Seconds between each doubling of the minimum refresh rate
+        next_backoff: float = time.monotonic() + backoff_interval
+        stats: Dict[int, RawStats] = self.pooling_raw_stats
+
+        # Bind the attributes used on every tick to locals so the loop does not look them up again
+        pid: int = self.pid
+        find_children: bool = self.find_children
+        wait = self.stop_event.wait
+        get_pids = self.stat_collector.get_pids
+        collect_stats = self.stat_collector.collect_stats
+        adapt_refresh_rate = self.adapt_refresh_rate
+        monotonic = time.monotonic
 
         while True:
+            # Waiting on the event instead of sleeping wakes the thread as soon as the stop signal is set
+            stopped: bool = wait(refresh_rate)
+
+            # The process tree is walked at most once every `children_ttl` seconds of the StatCollector
+            pids: List[int] = get_pids(find_children)
+
+            # Collecting the IO counters on every sample keeps the last ones of the children that die before the stop signal is received
+            stats = collect_stats(stats, pids, stopped)
+            if stopped:
+                break
+
+            if pid in stats:
+                refresh_rate = adapt_refresh_rate(stats[pid], refresh_rate, min_refresh_rate, max_refresh_rate)
+            # Compare against an absolute deadline since the sampling itself blocks for longer than refresh_rate
+            now: float = monotonic()
+            if now > next_backoff:
+                # Double the minimum refresh rate, but do not exceed max_refresh_rate
+                min_refresh_rate = min(min_refresh_rate * 2, max_refresh_rate)
+                refresh_rate = max(refresh_rate, min_refresh_rate)
+                next_backoff = now + backoff_interval
 
-            stats = self.stat_collector.collect_cpu_ram_stats(
-                stats, self.find_children, refresh_rate, self.success_queue
-            )
-
-            # This call will help if find children = True and some of them die before the STOP signal is received so IO counters for dead processes will not be collected.
-            stats = self.stat_collector.collect_io_counters(stats, self.find_children, self.success_queue)
-            if not self.stop_queue.empty():
-                message = self.stop_queue.get()
-                if message == "STOP":
-                    stats = self.stat_collector.collect_io_counters(stats, self.find_children, self.success_queue)
-                    self.data_pool_queue.put(stats)
-                    break
-            time.sleep(refresh_rate)
-            time_elapsed += refresh_rate
-            if time_elapsed > 10:
-                if refresh_rate < max_refresh_rate:
-                    refresh_rate = min(refresh_rate * 2, max_refresh_rate)
-                    # Double the refresh rate, but do not exceed max_refresh_rate
-                time_elapsed = 0.0
-
-    def calculate_delta(self, other: Self):
-        """
-        Calculate the difference between the current instance's stats_per_pid and another instance's stats_per_pid.
+    @staticmethod
+    def adapt_refresh_rate(
+        raw_stats: RawStats, refresh_rate: float, min_refresh_rate: float, max_refresh_rate: float
+    ) -> float:
+        """
+        Adapts the refresh rate to the variation of the last samples of the main process.
 
         Args:
-            other (Self): The other instance to compare stats_per_pid with.
+            raw_stats (RawStats): The samples collected so far for the main process.
+            refresh_rate (float): The current refresh rate.
+            min_refresh_rate (float): The refresh rate to go back to when the usage changes.
+            max_refresh_rate (float): The maximum refresh rate.
+
+        Returns:
+            float: The refresh rate for the next sample.
+
+        Note:
+            - The refresh rate is only adapted once there are 16 samples.
+            - The CPU usage is compared as the change between the means of the older and the newer half of the window, since single CPU
+              samples are quantized to the 10ms resolution of the CPU times and a steady busy process can read anywhere between 0 and 200%.
+            - If the CPU usage has changed at most 20 points and the RSS memory stayed within 1%, the refresh rate is increased by 50%, up to `max_refresh_rate`.
+            - If the CPU usage has changed more than 50 points or the RSS memory more than 10%, the refresh rate goes back to `min_refresh_rate`.
+        """
+        window: int = 16
+        if len(raw_stats.cpu_percent) < window:
+            return refresh_rate
+        half_window: int = window // 2
+        recent_cpu = raw_stats.cpu_percent[-window:]
+        recent_rss = raw_stats.rss_bytes[-window:]
+        cpu_change: float = abs(fsum(recent_cpu[half_window:]) - fsum(recent_cpu[:half_window])) / half_window
+        max_rss: int = max(recent_rss)
+        rss_spread: int = max_rss - min(recent_rss)
+
+        if cpu_change > 50 or rss_spread > max_rss * 0.1:
+            return min_refresh_rate
+        if cpu_change <= 20 and rss_spread <= max_rss * 0.01:
+            return min(refresh_rate * 1.5, max_refresh_rate)
+        return refresh_rate
+
+    def calculate_delta(self):
         """
-        subtracted_stats: Dict[int, Stats] = self.stat_collector.subtract_stats(self.stats_per_pid, other.stats_per_pid)
+        Calculate the difference between the monitored stats_per_pid and the baseline taken by `take_snapshot()`.
+        """
+        subtracted_stats: Dict[int, Stats] = self.stat_collector.subtract_stats(
+            self.stats_per_pid, self.baseline_stats_per_pid
+        )
         self.formated_stats: Stats = self.stat_collector.get_final_stats(subtracted_stats)
 
     def get_data(self):
@@ -207,38 +224,39 @@ class Monitoring:
         """
         data: Stats = self.formated_stats
         if verbose:
-            print("*" * 5, f"metrit data for function {func_name}:", "*" * 5)
-            print(f"\tArgs: {args}.")
-            print(f"\tKwargs: {kwargs}.")
-            print(f"Maximum CPU usage: {data.cpu_percentage_max:.2f}%.")
-            print(f"Average CPU usage: {data.cpu_percentage_avg:.2f}%.")
-            print(f"Average memory usage: {data.memory_percentage_avg:.2f}%.")
-            print(f"Maximum RSS memory usage: {format_size(data.rss_bytes_max)}.")
-            print(f"Average RSS memory usage: {format_size(data.rss_bytes_avg)}.")
-            print(f"Maximum VMS memory usage: {format_size(data.vms_bytes_max)}.")
-            print(f"Average VMS memory usage: {format_size(data.vms_bytes_avg)}.")
-
-            if platform != "darwin":
-                print(f"IO read count: {data.read_count}.")
-                print(f"IO writes count: {data.write_count}.")
-                print(f"IO read bytes: {format_size(data.read_bytes)}.")
-                print(f"IO write bytes: {format_size(data.write_bytes)}.")
-            print("*" * 5, "End of metrit data.", "*" * 5)
+            # Build the whole report first so it is written at once and is not interleaved with other output
+            lines: List[str] = [
+                f"{BANNER} metrit data for function {func_name}: {BANNER}",
+                f"\tArgs: {args}.",
+                f"\tKwargs: {kwargs}.",
+                f"Maximum CPU usage: {data.cpu_percentage_max:.2f}%.",
+                f"Average CPU usage: {data.cpu_percentage_avg:.2f}%.",
+                f"Average memory usage: {data.memory_percentage_avg:.2f}%.",
+                f"Maximum RSS memory usage: {format_size(data.rss_bytes_max)}.",
+                f"Average RSS memory usage: {format_size(data.rss_bytes_avg)}.",
+                f"Maximum VMS memory usage: {format_size(data.vms_bytes_max)}.",
+                f"Average VMS memory usage: {format_size(data.vms_bytes_avg)}.",
+            ]
+            if not IS_MACOS:
+                lines += [
+                    f"IO read count: {data.read_count}.",
+                    f"IO writes count: {data.write_count}.",
+                    f"IO read bytes: {format_size(data.read_bytes)}.",
+                    f"IO write bytes: {format_size(data.write_bytes)}.",
+                ]
+            lines.append(f"{BANNER} End of metrit data. {BANNER}")
+            print("\n".join(lines))
         else:
             func_name_spacing = 30
             func_name = f"'{func_name}'"
             if len(func_name) > func_name_spacing:
                 func_name = func_name[: func_name_spacing - 4] + "..." + "'"
-            if platform != "darwin":
-                output_format = "Function {:30} {:>8} avg of memory {:>8.2f}% avg of CPU {:>8} IO reads {:>8} IO writes"
-                output = output_format.format(
-                    func_name,
-                    format_size(data.rss_bytes_avg),
-                    data.cpu_percentage_avg,
-                    format_size(data.read_bytes),
-                    format_size(data.write_bytes),
-                )
-            else:
-                output_format = "Function {:30} {:>8} avg of memory {:>8.2f}% avg of CPU"
-                output = output_format.format(func_name, format_size(data.rss_bytes_avg), data.cpu_percentage_avg)
+            # The IO values are ignored by the format on macOS
+            output = SUMMARY_FORMAT.format(
+                func_name,
+                format_size(data.rss_bytes_avg),
+                data.cpu_percentage_avg,
+                format_size(data.read_bytes),
+                format_size(data.write_bytes),
+            )
             print(output)
@@ -1,14 +1,25 @@
-from statistics import mean
-from sys import platform
-from typing import Dict, Tuple
+import os
+import time
+from math import fsum
+from typing import Dict, List, Sequence, Tuple
 
 import psutil
-from multiprocess import Queue, current_process  # type: ignore
 
 from .Stats import RawStats, Stats
+from .utils import IS_MACOS
 
 
 class StatCollector:
+    # psutil.Process objects are shared between instances since building them reads /proc on every construction.
+    # Their `cpu_percent()` state would be shared too, so the CPU usage is measured from `cpu_times()` per instance instead
+    process_cache: Dict[int, psutil.Process] = {}
+    # The total physical memory does not change while running, so it is read once to compute the memory percentages
+    total_memory: int = psutil.virtual_memory().total
+    # Walking the process tree reads every process of the system, so the children are reused for a short time between samples
+    children_ttl: float = 0.1
+    # The CPU times have a resolution of one scheduler tick (10ms), so shorter intervals read as 0, 100 or 200% of a core
+    cpu_interval: float = 0.1
+
     def __init__(self, pid):
         """
         Initializes a new instance of the StatCollector class.
@@ -19,173 +30,216 @@ class StatCollector:
         """
         self.pid = pid
         self.stats = {}
+        self.has_crashed: bool = False  # Set when a collection fails. A plain flag since the collection runs in the same process
+        self.children_pids: List[int] = []
+        self.children_expire_time: float = 0.0  # time.monotonic() value after which the children are walked again
+        # CPU time (user + system) and time.monotonic() value of the previous CPU read of each process, as {pid: (cpu_time, timestamp)}
+        self.cpu_times_per_pid: Dict[int, Tuple[float, float]] = {}
+        self.cpu_percent_per_pid: Dict[int, float] = {}  # Last CPU percentage of each process, repeated until the next CPU read
+
+    def get_pids(self, find_children: bool) -> List[int]:
+        """
+        Gets the process ID of the process and, if requested, the process IDs of all its children.
+        The process tree is walked at most once every `children_ttl` seconds, and the children are reused in between.
+
+        Args:
+            find_children (bool): Whether to include the process's children.
+
+        Returns:
+            List[int]: The process ID of the process followed by the process IDs of its children.
+        """
+        if not find_children:
+            return [self.pid]
+        now: float = time.monotonic()
+        if now < self.children_expire_time:
+            return [self.pid] + self.children_pids
+        try:
+            children = self.get_process(self.pid).children(recursive=True)
+        except Exception:
+            return [self.pid]  # If the process tree can't be read, the collectors will report the error
+        # The sampling runs in a thread of the monitored process, so the current process is never one of its children
+        self.children_pids = [child.pid for child in children]
+        self.children_expire_time = now + self.children_ttl
+        return [self.pid] + self.children_pids
 
-    def collect_cpu_ram_stats(
-        self, stats: Dict, find_children: bool, refresh_rate: float, sucesss_queue: Queue
-    ) -> Dict[int, RawStats]:
+    def collect_stats(self, stats: Dict, pids: List[int], is_last_sample: bool = False) -> Dict[int, RawStats]:
         """
-        Collects current CPU and RAM stats for the process and its children.
+        Collects current CPU, RAM and IO stats for the process and its children.
 
         Args:
             stats (Dict): A dictionary to store the collected stats as {pid: RawStats}.
-            find_children (bool): Whether to collect stats for the process's children.
-            refresh_rate (float): The refresh rate for collecting stats.
-            sucesss_queue (Queue): A queue to indicate the success of stats collection.
+            pids (List[int]): The process IDs to collect stats for, as returned by `self.get_pids()`.
+            is_last_sample (bool, optional): Whether it is the last sample of the monitoring. See `self.get_cpu_percent()`. Defaults to False.
 
         Returns:
             Dict: The updated dictionary containing the collected stats as {pid: RawStats}.
 
-        Raises:
-            Exception: If there is an error collecting the stats.
+        Note:
+            - The stats of every process are read with `self.get_current_stats()`, so each sample reads the process information once.
+            - If a child process does not exist anymore, 0 is stored for its CPU and RAM stats and its last IO stats are kept.
+            - If the stats of the main process can't be read, an error message is printed and `self.has_crashed` is set to True.
         """
-        # Collect current CPU and RAM stats for the process and its children
         try:
-            cpu_percent, memory_percent, rss_bytes, vms_bytes = self.get_current_stats(self.pid, refresh_rate)
-            if self.pid not in stats:
-                stats[self.pid] = RawStats()
-            stats[self.pid].cpu_percent.append(cpu_percent)
-            stats[self.pid].memory_percent.append(memory_percent)
-            stats[self.pid].rss_bytes.append(rss_bytes)
-            stats[self.pid].vms_bytes.append(vms_bytes)
-            if find_children:
-
-                for child in psutil.Process(self.pid).children(recursive=True):
-                    try:
-                        if child.pid == current_process().pid:  # Avoid counting the current process
-                            continue
-                        cpu_percent, memory_percent, rss_bytes, vms_bytes = self.get_current_stats(
-                            child.pid, refresh_rate
-                        )
-                        if child.pid not in stats:
-                            stats[child.pid] = RawStats()
-                        stats[child.pid].cpu_percent.append(cpu_percent)
-                        stats[child.pid].memory_percent.append(memory_percent)
-                        stats[child.pid].rss_bytes.append(rss_bytes)
-                        stats[child.pid].vms_bytes.append(vms_bytes)
-                    except Exception:
-                        continue  # It is possible for some children processes to not exist, so we skip them
-
-            sucesss_queue.put(True)
+            for pid in pids:
+                try:
+                    cpu_percent, memory_percent, rss_bytes, vms_bytes, io_counters = self.get_current_stats(pid, is_last_sample)
+                except Exception:
+                    self.process_cache.pop(pid, None)  # The process is gone or its pid may be reused
+                    self.cpu_times_per_pid.pop(pid, None)
+                    self.cpu_percent_per_pid.pop(pid, None)
+                    if pid == self.pid:
+                        raise
+                    # It is possible for some children processes to not exist anymore, so the tree is walked again on the next sample
+                    self.children_expire_time = 0.0
+                    cpu_percent, memory_percent, rss_bytes, vms_bytes, io_counters = 0.0, 0.0, 0, 0, None
+                if pid not in stats:
+                    stats[pid] = RawStats()
+                pid_stats: RawStats = stats[pid]
+                if cpu_percent is not None:
+                    # The samples taken before the first CPU read of the process get its value
+                    missing_samples: int = len(pid_stats.rss_bytes) - len(pid_stats.cpu_percent)
+                    pid_stats.cpu_percent.extend([cpu_percent] * (missing_samples + 1))
+                pid_stats.memory_percent.append(memory_percent)
+                pid_stats.rss_bytes.append(rss_bytes)
+                pid_stats.vms_bytes.append(vms_bytes)
+                if io_counters is not None:
+                    (
+                        pid_stats.io_read_count,
+                        pid_stats.io_write_count,
+                        pid_stats.io_read_bytes,
+                        pid_stats.io_write_bytes,
+                    ) = io_counters
         except Exception as e:
-            print(f"Error collecting cpu and ram stats: {e}")
-            sucesss_queue.put(False)
+            print(f"Error collecting stats: {e}")
+            self.has_crashed = True
         finally:
             return stats
 
     @staticmethod
-    def get_current_stats(pid: int, refresh_rate: float) -> Tuple[float, float, int, int]:
+    def get_process(pid: int) -> psutil.Process:
         """
-        Get the current CPU and memory usage statistics for a given process ID (PID).
+        Gets the psutil.Process object for a given process ID, reusing the cached one if it exists.
 
-        Parameters:
-            pid (int): The process ID (PID) of the process to get the stats for.
-            refresh_rate (float): The interval (in seconds) to refresh the CPU usage.
+        Args:
+            pid (int): The process ID of the process.
 
         Returns:
-            Tuple[float, float, int, int]: A tuple containing the CPU percentage, memory percentage, RSS (resident set size) in bytes, and VMS (virtual memory size) in bytes.
+            psutil.Process: The psutil.Process object for the given process ID.
 
-         Note:
-            - The CPU percentage is calculated using `psutil.Process.cpu_percent()` with the given `refresh_rate`.
-            - The memory information is obtained using `psutil.Process.as_dict()` with the attributes "memory_info" and "memory_percent".
-            - If there is an error getting the stats, the function returns 0.0 for CPU and memory percentages, and 0 for RSS and VMS.
+        Raises:
+            psutil.NoSuchProcess: If the process does not exist.
         """
-        # Use psutil to get the stats for a given PID
-        try:
-            p = psutil.Process(pid)
-            cpu_percent = p.cpu_percent(interval=refresh_rate)
-            memory_info = p.as_dict(attrs=["memory_info", "memory_percent"])
-            memory_percent = memory_info["memory_percent"]
-            rss_bytes = memory_info["memory_info"].rss
-            vms_bytes = memory_info["memory_info"].vms
-        except Exception:
-            # print(f"Error getting cpu and ram stats for PID {pid}. {e}")
-            return 0.0, 0.0, 0, 0
-        return cpu_percent, memory_percent, rss_bytes, vms_bytes
+        process = StatCollector.process_cache.get(pid)
+        if process is None:
+            process = psutil.Process(pid)
+            StatCollector.process_cache[pid] = process
+        return process
+
+    def prime_cpu_percent(self, pids: List[int]) -> None:
+        """
+        Starts the CPU usage measurement for the given process IDs.
+        The following `self.get_current_stats()` calls will return the usage since this call, so the sampling never has to wait for the CPU usage.
+
+        Args:
+            pids (List[int]): The process IDs to start measuring.
+        """
+        for pid in pids:
+            try:
+                self.cpu_times_per_pid[pid] = (self.get_cpu_time(self.get_process(pid)), time.monotonic())
+                self.cpu_percent_per_pid.pop(pid, None)
+            except Exception:
+                StatCollector.process_cache.pop(pid, None)  # The process is gone or its pid may be reused
 
-    def collect_io_counters(self, stats, find_children: bool, sucesss_queue: Queue) -> Dict[int, RawStats]:
+    @staticmethod
+    def get_cpu_time(process: psutil.Process) -> float:
         """
-        Collects IO stats for the process and its children.
+        Gets the CPU time spent by a process, as `psutil.Process.cpu_percent()` measures it.
 
         Args:
-            stats (Dict): A dictionary to store the collected stats.
-            find_children (bool): Whether to collect stats for the process's children.
-            sucesss_queue (Queue): A queue to communicate success or failure.
+            process (psutil.Process): The process to read the CPU time from.
 
         Returns:
-            Dict: The updated stats dictionary in form of {pid: RawStats}.
+            float: The user and system CPU time of the process in seconds.
 
         Note:
-            - If the platform is "darwin" (macos), the function returns the stats dictionary as is since IO stats are not supported for macOS.
-            - The IO stats for the process and its children are collected using `self.get_io_counters()`.
-            - The stats are stored in the `stats` dictionary with the process ID as the key.
-            - If `find_children` is True, the function iterates over the process's children and collects their IO stats.
-            - If a child process does not exist, it is skipped.
-            - The function puts True in the `sucesss_queue` if the stats collection is successful, False otherwise.
-            - If there is an exception during the stats an error message is printed and False is put in the `sucesss_queue`.
+            - The monitoring runs in the monitored process, so its CPU time is read with `time.process_time()`, which has a much finer
+              resolution than the 10ms ticks reported by `psutil.Process.cpu_times()` and also measures functions shorter than a tick.
         """
-        if platform == "darwin":
-            return stats
-        # Collect IO stats for the process and its children
-        try:
-            io_read_count, io_write_count, io_read_bytes, io_write_bytes = self.get_io_counters(self.pid)
-            if self.pid not in stats:
-                stats[self.pid] = RawStats()
-            stats[self.pid].io_read_count = io_read_count
-            stats[self.pid].io_write_count = io_write_count
-            stats[self.pid].io_read_bytes = io_read_bytes
-            stats[self.pid].io_write_bytes = io_write_bytes
-
-            if find_children:
-                for child in psutil.Process(self.pid).children(recursive=True):
-                    try:
-                        if child.pid == current_process().pid:  # Avoid counting the current process
-                            continue
-                        io_read_count, io_write_count, io_read_bytes, io_write_bytes = self.get_io_counters(child.pid)
-                        if child.pid not in stats:
-                            stats[child.pid] = RawStats()
-                        stats[child.pid].io_read_count = io_read_count
-                        stats[child.pid].io_write_count = io_write_count
-                        stats[child.pid].io_read_bytes = io_read_bytes
-                        stats[child.pid].io_write_bytes = io_write_bytes
-                    except Exception:
-                        if child.pid in stats and (
-                            stats[child.pid].io_read_count != 0
-                            and stats[child.pid].io_write_count != 0  # noqa: W503
-                            and stats[child.pid].io_read_bytes != 0  # noqa: W503
-                            and stats[child.pid].io_write_bytes != 0  # noqa: W503
-                        ):
-                            continue  # This continue is to make the code more clear, but the whole condition could be removed
-
-                        continue  # It is possible for some children processes to not exist, so we skip them
-
-            sucesss_queue.put(True)
-        except Exception as e:
-            print(f"Error collecting io stats: {e}")
-            sucesss_queue.put(False)
-        finally:
-            return stats
-
-    @staticmethod
-    def get_io_counters(pid: int) -> Tuple[int, int, int, int]:
+        if process.pid == os.getpid():
+            return time.process_time()
+        cpu_times = process.cpu_times()
+        return cpu_times.user + cpu_times.system
+
+    def get_cpu_percent(
+        self, pid: int, cpu_time: float, timestamp: float, is_last_sample: bool = False
+    ) -> float | None:
         """
-        Get the IO counters for a given process ID.
+        Calculates the CPU usage of a process since its previous CPU read once at least `cpu_interval` seconds have passed.
+        In between, the previous CPU percentage is repeated so the samples of the RSS and IO stats can be taken faster.
 
         Args:
-            pid (int): The process ID of the process to get the IO counters for.
+            pid (int): The process ID of the process.
+            cpu_time (float): The CPU time of the process, as returned by `self.get_cpu_time()`.
+            timestamp (float): The time.monotonic() value when `cpu_time` was read.
+            is_last_sample (bool, optional): Whether it is the last sample of the monitoring. If the process has no CPU percentage yet,
+                it is calculated over the elapsed time even if it is shorter than `cpu_interval`, so short functions are not reported as idle. Defaults to False.
 
         Returns:
-            Tuple[int, int, int, int]: A tuple containing the read count, write count, read bytes, and write bytes of the process's IO counters.
+            float | None: The CPU percentage of the last CPU read, or None if the process has no CPU percentage yet.
+        """
+        previous = self.cpu_times_per_pid.get(pid)
+        if previous is None:
+            self.cpu_times_per_pid[pid] = (cpu_time, timestamp)
+            return None
+        last_cpu_percent: float | None = self.cpu_percent_per_pid.get(pid)
+        elapsed: float = timestamp - previous[1]
+        if elapsed < self.cpu_interval and not (is_last_sample and last_cpu_percent is None and elapsed > 0):
+            return last_cpu_percent
+        cpu_percent: float = (cpu_time - previous[0]) / elapsed * 100
+        self.cpu_times_per_pid[pid] = (cpu_time, timestamp)
+        self.cpu_percent_per_pid[pid] = cpu_percent
+        return cpu_percent
+
+    def get_current_stats(
+        self, pid: int, is_last_sample: bool = False
+    ) -> Tuple[float | None, float, int, int, Tuple[int, int, int, int] | None]:
+        """
+        Get the current CPU, memory and IO statistics for a given process ID (PID).
 
-        Note:
-            If there is an error getting the stats for the process ID, the function returns 0 for all counters.
+        Parameters:
+            pid (int): The process ID (PID) of the process to get the stats for.
+            is_last_sample (bool, optional): Whether it is the last sample of the monitoring. See `self.get_cpu_percent()`. Defaults to False.
+
+        Returns:
+            Tuple[float | None, float, int, int, Tuple[int, int, int, int] | None]: A tuple containing the CPU percentage (None until the first CPU read), memory percentage, RSS (resident set size) in bytes, VMS (virtual memory size) in bytes
+            and the read count, write count, read bytes and write bytes of the IO counters, or None on macOS where they are not supported.
+
+        Raises:
+            psutil.Error: If the stats of the process can't be read.
+
+         Note:
+            - The CPU percentage is calculated from `psutil.Process.cpu_times()` without blocking, so it is the usage since the previous CPU read of this instance for the same PID. See `prime_cpu_percent()` and `get_cpu_percent()`.
+            - The CPU baseline is kept per instance, so several monitors of the same process, as in nested calls, do not reset each other's measurement.
+            - The memory information is obtained using `psutil.Process.memory_info()` and the memory percentage is calculated from its RSS, as `psutil.Process.memory_percent()` does, without reading it again.
+            - All the reads are done inside `psutil.Process.oneshot()` so the process information is retrieved once.
         """
-        try:
-            p = psutil.Process(pid)
-        except Exception:
-            print(f"Error getting stats for PID {pid}")
-            return 0, 0, 0, 0
-        io_counters = p.io_counters()  # type: ignore
-        return io_counters.read_count, io_counters.write_count, io_counters.read_bytes, io_counters.write_bytes
+        p = StatCollector.get_process(pid)
+        with p.oneshot():  # Share the /proc (or platform equivalent) reads between the CPU, memory and IO calls
+            cpu_time = self.get_cpu_time(p)
+            timestamp = time.monotonic()
+            memory_info = p.memory_info()
+            io_counters = p.io_counters() if not IS_MACOS else None  # type: ignore
+        return (
+            self.get_cpu_percent(pid, cpu_time, timestamp, is_last_sample),
+            memory_info.rss / StatCollector.total_memory * 100,
+            memory_info.rss,
+            memory_info.vms,
+            (
+                (io_counters.read_count, io_counters.write_count, io_counters.read_bytes, io_counters.write_bytes)
+                if io_counters is not None
+                else None
+            ),
+        )
 
     def calculate_statistics_from_data(self, raw_stats: Dict[int, RawStats]) -> Dict[int, Stats]:
         """
@@ -211,20 +265,42 @@ class StatCollector:
             Stats: The calculated statistics.
 
         """
+        cpu_percentage_max, cpu_percentage_avg = StatCollector.max_and_mean(data.cpu_percent)
+        rss_bytes_max, rss_bytes_avg = StatCollector.max_and_mean(data.rss_bytes)
+        vms_bytes_max, vms_bytes_avg = StatCollector.max_and_mean(data.vms_bytes)
         return Stats(
-            cpu_percentage_max=max(data.cpu_percent) if data.cpu_percent else 0.0,
-            cpu_percentage_avg=mean(data.cpu_percent) if data.cpu_percent else 0.0,
-            memory_percentage_avg=mean(data.memory_percent) if data.memory_percent else 0.0,
-            rss_bytes_avg=mean(data.rss_bytes) if data.rss_bytes else 0.0,
-            rss_bytes_max=max(data.rss_bytes) if data.rss_bytes else 0,
-            vms_bytes_avg=mean(data.vms_bytes) if data.vms_bytes else 0.0,
-            vms_bytes_max=max(data.vms_bytes) if data.vms_bytes else 0,
+            cpu_percentage_max=cpu_percentage_max,
+            cpu_percentage_avg=cpu_percentage_avg,
+            memory_percentage_avg=fsum(data.memory_percent) / len(data.memory_percent) if data.memory_percent else 0.0,
+            rss_bytes_avg=rss_bytes_avg,
+            rss_bytes_max=rss_bytes_max,
+            vms_bytes_avg=vms_bytes_avg,
+            vms_bytes_max=vms_bytes_max,
             write_count=data.io_write_count if data.io_write_count is not None else 0,
             read_count=data.io_read_count if data.io_read_count is not None else 0,
             write_bytes=data.io_write_bytes if data.io_write_bytes is not None else 0,
             read_bytes=data.io_read_bytes if data.io_read_bytes is not None else 0,
         )
 
+    @staticmethod
+    def max_and_mean(values: Sequence[float]) -> Tuple[float, float]:
+        """
+        Calculates the maximum and the mean of the given samples.
+
+        Args:
+            values (Sequence[float]): The samples, usually one of the arrays of a RawStats object.
+
+        Returns:
+            Tuple[float, float]: The maximum and the mean of the samples, or (0, 0.0) if there are no samples.
+
+        Note:
+            - Both reductions run as C loops over the array (`max()` and `math.fsum()`), which is faster than a single
+              traversal written in Python and avoids the exact fraction arithmetic of `statistics.mean()`.
+        """
+        if not values:
+            return 0, 0.0
+        return max(values), fsum(values) / len(values)
+
     @staticmethod
     def subtract_stats(main: Dict[int, Stats], other: Dict[int, Stats]) -> Dict[int, Stats]:
         """
@@ -251,6 +327,8 @@ class StatCollector:
         result = {}
         if not main:
             return result
+        if not other:
+            return dict(main)  # Nothing to subtract
         for pid, stats_main in main.items():
             if pid in other:
                 stats_b = other[pid]
@@ -1,13 +1,15 @@
+from array import array
 from dataclasses import dataclass, field
-from typing import List
+from functools import partial
 
 
 @dataclass(slots=True)
 class RawStats:
-    cpu_percent: List[float] = field(default_factory=list)
-    memory_percent: List[float] = field(default_factory=list)
-    rss_bytes: List[int] = field(default_factory=list)
-    vms_bytes: List[int] = field(default_factory=list)
+    # Samples are stored unboxed in typed arrays: 'd' for percentages and 'q' for byte counts
+    cpu_percent: array = field(default_factory=partial(array, "d"))
+    memory_percent: array = field(default_factory=partial(array, "d"))
+    rss_bytes: array = field(default_factory=partial(array, "q"))
+    vms_bytes: array = field(default_factory=partial(array, "q"))
     io_read_count: int = 0
     io_write_count: int = 0
     io_read_bytes: int = 0
@@ -1,19 +1,59 @@
 import inspect
-from collections import deque
+import pickle
+import threading
 from functools import partial, wraps
-from typing import Any, Callable, Dict, Tuple
+from sys import platform
+from typing import Any, Callable, Dict, List, Tuple
 
-from multiprocess import Queue  # type: ignore
+from multiprocess import get_context  # type: ignore
+from multiprocess.connection import Connection  # type: ignore
 
 from metrit.Monitoring import Monitoring
-from metrit.utils import check_is_recursive_func, extract_callable_and_args_if_method
+from metrit.utils import (
+    check_is_recursive_func,
+    extract_callable_and_args_if_method,
+    get_func_key,
+    release_called_func,
+)
 
 
 class MetritConfig:
     ACTIVE: bool = True
 
 
-called_isolated_func_queue = Queue()
+# Forking lets the isolated process inherit the decorated function instead of pickling it with dill.
+# Other platforms keep their default start method since forking is not safe on macOS and not available on Windows
+mp_context = get_context("fork") if platform.startswith("linux") else get_context()
+# Forking while other threads run, such as the monitor thread of an outer non-isolated call, can deadlock the child on a lock
+# held by one of those threads, and Python 3.12+ warns about it. In that case the isolated process is forked from the
+# single-threaded forkserver process instead, at the cost of pickling the function with dill
+threaded_mp_context = get_context("forkserver") if platform.startswith("linux") else mp_context
+
+# Key of the function run by the current process when it is an isolated process. It is only set in the isolated process
+isolated_func_key: Tuple[str, str, bytes | None] | None = None
+# Active calls are tracked per thread so concurrent calls from different threads are not taken as recursive calls
+called_funcs_state = threading.local()
+
+
+def get_called_func_counter() -> Dict[int, int]:
+    """
+    Gets the number of active calls of each decorated function in the current thread, keyed by the function id.
+    Returns:
+        Dict[int, int]: The counter of the current thread. It is created on the first call of each thread.
+    """
+    counter: Dict[int, int] | None = getattr(called_funcs_state, "counter", None)
+    if counter is None:
+        counter = called_funcs_state.counter = {}
+    return counter
+
+
+def get_mp_context():
+    """
+    Gets the multiprocessing context used to start the isolated processes.
+    Returns:
+        The fork context on Linux if the current process runs a single thread, `threaded_mp_context` otherwise.
+    """
+    return mp_context if threading.active_count() == 1 else threaded_mp_context
 
 
 def metrit(*args: Any, verbose: bool = False, find_children: bool = False, isolate: bool = True) -> Callable:
@@ -39,6 +79,7 @@ def metrit(*args: Any, verbose: bool = False, find_children: bool = False, isola
         - Classes will be returned unmodified and will not be decorated.
         - If the function is a method, it won't be isolated.
         - If isolate==True and it crashes in the process, it will be tried again in the main process.
+        - If the MetritConfig ACTIVE flag is set to false after decorating, the decorated callable will be executed without monitoring.
 
 
 
@@ -84,34 +125,48 @@ def _decorator(func: Callable, verbose: bool = False, find_children: bool = Fals
         # If a class is found, return the class inmediatly since it could raise an exception if triggered from other processes
         return func
 
-    called_func_stack: deque[Callable] = deque()
+    # These properties only depend on the decorated object so they are computed once instead of on every call
+    func_id: int = id(func)
+    func_name: str = func.__name__
+    is_classmethod: bool = isinstance(func, classmethod)
+    is_staticmethod: bool = isinstance(func, staticmethod)
+    # Identifies the function in the isolated processes, where the recursion can't be tracked by its id
+    func_key: Tuple[str, str, bytes | None] = get_func_key(func)
+    # Whether it is called as a method can only be known from the arguments, so that check is the only one left per call
+    extract_callable_and_args: Callable[..., Tuple[Callable, Tuple, Tuple, bool]] = partial(
+        extract_callable_and_args_if_method, func, func_name, is_classmethod, is_staticmethod
+    )
 
     @wraps(func)
     def metrit_wrapper(*args: Tuple, **kwargs: Dict) -> Any:
-        nonlocal called_func_stack
-        global called_isolated_func_queue
-
-        is_recursive: bool = check_is_recursive_func(func, called_func_stack, called_isolated_func_queue)
-
-        callable_func, args, args_to_print, is_method = extract_callable_and_args_if_method(func, *args)
+        if not MetritConfig.ACTIVE:
+            # Fast path if the decorator has been deactivated after decorating the function
+            if is_classmethod or is_staticmethod:
+                callable_func, args, _, _ = extract_callable_and_args(*args)
+                return callable_func(*args, **kwargs)
+            return func(*args, **kwargs)
+
+        callable_func, args, args_to_print, is_method = extract_callable_and_args(*args)
+        called_func_counter: Dict[int, int] = get_called_func_counter()
+        is_recursive: bool = check_is_recursive_func(func_key, func_id, called_func_counter, isolated_func_key)
         if is_recursive:
-            return handle_recursive_call(callable_func, called_func_stack, called_isolated_func_queue, *args, **kwargs)
-
-        crashed: bool = False
-        if isolate and not is_method:
-            try:
-                result, pool_monitor_data = isolate_function(find_children, callable_func, *args, **kwargs)
-            except Exception:
-                crashed = True
-
-        if crashed or not isolate or is_method:
-            result, pool_monitor_data = call_func(find_children, callable_func, *args, **kwargs)
-
-        called_func_stack.pop()
-        if not called_isolated_func_queue.empty():
-            called_isolated_func_queue.get()  # Consume the queue
-
-        if not called_func_stack and called_isolated_func_queue.empty():
+            return handle_recursive_call(callable_func, func_id, called_func_counter, *args, **kwargs)
+
+        try:
+            crashed: bool = False
+            if isolate and not is_method:
+                try:
+                    result, pool_monitor_data = isolate_function(find_children, func_key, callable_func, *args, **kwargs)
+                except Exception:
+                    crashed = True
+
+            if crashed or not isolate or is_method:
+                result, pool_monitor_data = call_func(find_children, callable_func, *args, **kwargs)
+        finally:
+            # Release the call even if the function raises, otherwise the next calls would be taken as recursive
+            release_called_func(func_id, called_func_counter)
+
+        if func_id not in called_func_counter:
             pool_monitor_data.print(verbose, callable_func.__name__, args_to_print, kwargs)
 
         return result
@@ -120,26 +175,30 @@ def _decorator(func: Callable, verbose: bool = False, find_children: bool = Fals
 
 
 def handle_recursive_call(
-    func: Callable, called_func_stack: deque, called_isolated_func_queue: Queue, *args: Tuple, **kwargs: Dict
+    func: Callable,
+    func_id: int,
+    called_func_counter: Dict[int, int],
+    *args: Tuple,
+    **kwargs: Dict,
 ) -> Any:
     """
     Handle a recursive call by executing the given function with the provided arguments and keyword arguments.
 
     Parameters:
         func (Callable): The function to be executed.
-        called_func_stack (deque): A stack of potential recursive functions.
+        func_id (int): The id of the decorated function, used as the key of the counter.
+        called_func_counter (Dict[int, int]): The number of active calls of each potential recursive function.
         *args: Variable length argument list.
         **kwargs: Arbitrary keyword arguments.
 
     Returns:
         Any: The result of executing the function.
     """
-    result: Any = func(*args, **kwargs)
-
-    called_func_stack.pop()
-    if not called_isolated_func_queue.empty():
-        called_isolated_func_queue.get()  # Consume one element of the queue
-    return result
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # Release the call even if the function raises, otherwise the next calls would be taken as recursive
+        release_called_func(func_id, called_func_counter)
 
 
 def call_func(find_children: bool, func: Callable, *args: Tuple, **kwargs: Dict) -> Tuple[Any, Monitoring]:
@@ -161,10 +220,9 @@ def call_func(find_children: bool, func: Callable, *args: Tuple, **kwargs: Dict)
         Exception: If an exception occurs during the execution of the function.
     """
 
-    pre_monitor_data = Monitoring(find_children=find_children)
-    pre_monitor_data.take_snapshot()
-
+    # The same instance takes the baseline and monitors the function, so the process and children reads are shared
     pool_monitor_data = Monitoring(find_children=find_children)
+    pool_monitor_data.take_snapshot()
     pool_monitor_data.start_monitoring()
     try:
         result: Any = func(*args, **kwargs)
@@ -176,15 +234,18 @@ def call_func(find_children: bool, func: Callable, *args: Tuple, **kwargs: Dict)
         raise e
 
     pool_monitor_data.stop_monitoring()
-    pool_monitor_data.calculate_delta(pre_monitor_data)
+    pool_monitor_data.calculate_delta()
     return result, pool_monitor_data
 
 
-def isolate_function(find_children: bool, func: Callable, *args: Tuple, **kwargs: Dict) -> Tuple[Any, Monitoring]:
+def isolate_function(
+    find_children: bool, func_key: Tuple[str, str, bytes | None], func: Callable, *args: Tuple, **kwargs: Dict
+) -> Tuple[Any, Monitoring]:
     """
     Isolates the given function in a separate process and monitors its resource usage.
     Args:
         find_children (bool): Whether to find children processes.
+        func_key (Tuple[str, str, bytes | None]): The key of the function, used to detect recursive calls in the isolated process.
         func (Callable): The function to be executed.
         *args: Variable length argument list.
         **kwargs: Arbitrary keyword arguments.
@@ -194,45 +255,49 @@ def isolate_function(find_children: bool, func: Callable, *args: Tuple, **kwargs
         Exception: If an exception occurs during the execution of the function.
         This exception will be handled in the main process and try again the execution and measurement of the function in the main process.
     """
-    from multiprocess import Process  # type: ignore
-
-    data_queue = Queue()
-    result_queue = Queue()
-    error_queue = Queue()
+    context = get_mp_context()
+    # A single one-way pipe is enough for the one message sent back by the isolated process
+    receiver, sender = context.Pipe(duplex=False)
+    func_process = None  # Only set once the process has started, since start() raises if the arguments can't be pickled
 
     try:
 
-        func_process: Process = Process(
+        process = context.Process(
             target=call_func_isolated,
-            args=(find_children, func, data_queue, result_queue, error_queue, args),
+            args=(find_children, func_key, func, sender, args),
             kwargs=kwargs,
         )
 
-        func_process.start()
+        process.start()
+        func_process = process
+        sender.close()  # Only the isolated process writes, so recv() raises EOFError if it dies without sending anything
+        # Receive before joining since the isolated process blocks on send() until a large result is read
+        succeeded, payload = receiver.recv()
+        if not succeeded:
+            func_process.join()
+            raise payload
+
+        pool_monitor_data: Monitoring = payload
+        result: Any = recv_result(receiver)
         func_process.join()
-        if not error_queue.empty():
-            raise error_queue.get()
-
-        pool_monitor_data = data_queue.get()
-        result = result_queue.get()
-        result_queue.close()
-        data_queue.close()
-
         return result, pool_monitor_data
 
     except Exception as e:
-        func_process.join()
-        func_process.terminate()
+        if func_process is not None:
+            func_process.join()
+            func_process.terminate()
         print("Error trying to isolate the process. Trying it again in main process:", e)
         raise e
+    finally:
+        sender.close()
+        receiver.close()
 
 
 def call_func_isolated(
     find_children: bool,
+    func_key: Tuple[str, str, bytes | None],
     func: Callable,
-    data_queue: Queue,
-    result_queue: Queue,
-    error_queue: Queue,
+    sender: Connection,
     args: Tuple,
     **kwargs: Dict,
 ):
@@ -241,10 +306,9 @@ def call_func_isolated(
 
     Args:
         find_children (bool): Whether to find child processes.
+        func_key (Tuple[str, str, bytes | None]): The key of the function, used to detect recursive calls.
         func (Callable): The function to be executed.
-        data_queue (Queue): The queue to store the monitoring data.
-        result_queue (Queue): The queue to store the result of the function.
-        error_queue (Queue): The queue to store any exceptions that occur during execution.
+        sender (Connection): The pipe end to send `(True, monitoring data)` followed by the result, or `(False, exception)` through.
         args (Tuple): The positional arguments to be passed to the function.
         **kwargs (Dict): The keyword arguments to be passed to the function.
 
@@ -253,25 +317,75 @@ def call_func_isolated(
 
     Raises:
         Exception: If an exception occurs during the execution of the function.
-            The exception is put into the error_queue.
+            The exception is sent through the pipe.
 
     """
-    global called_isolated_func_queue
-    called_isolated_func_queue.put(func)
-    pre_monitor_data = Monitoring(find_children=find_children)
-    pre_monitor_data.take_snapshot()
+    global isolated_func_key
+    isolated_func_key = func_key  # Only visible in this process, so the calling process is not affected
     pool_monitor_data = Monitoring(find_children=find_children)
+    pool_monitor_data.take_snapshot()
     pool_monitor_data.start_monitoring()
 
     try:
         result: Any = func(*args, **kwargs)
     except Exception as e:
         pool_monitor_data.stop_monitoring()
-        called_isolated_func_queue.get()
-        error_queue.put(e)
+        sender.send((False, e))
+        sender.close()
         return
 
     pool_monitor_data.stop_monitoring()
-    pool_monitor_data.calculate_delta(pre_monitor_data)
-    data_queue.put(pool_monitor_data)
-    result_queue.put(result)
+    pool_monitor_data.calculate_delta()
+    sender.send((True, pool_monitor_data))
+    send_result(sender, result)
+    sender.close()
+
+
+def send_result(sender: Connection, result: Any) -> None:
+    """
+    Sends the result of an isolated function through a pipe, to be received with `recv_result`.
+
+    Args:
+        sender (Connection): The pipe end to send the result through.
+        result (Any): The result of the function.
+
+    Note:
+        - The result is pickled with the standard pickle and protocol 5 when possible, which is much faster than dill for large data.
+        - Buffers that support it, such as bytearrays or numpy arrays, are sent out-of-band instead of being copied into the pickle.
+        - Results that only dill can serialize, such as lambdas, are sent with `Connection.send()`.
+    """
+    buffers: List[memoryview] = []
+    try:
+        pickled_result: bytes = pickle.dumps(
+            result, protocol=5, buffer_callback=lambda buffer: buffers.append(buffer.raw())
+        )
+    except Exception:
+        sender.send((False, result))
+        return
+    sender.send((True, [buffer.nbytes for buffer in buffers]))
+    sender.send_bytes(pickled_result)
+    for buffer in buffers:
+        sender.send_bytes(buffer)
+
+
+def recv_result(receiver: Connection) -> Any:
+    """
+    Receives the result of an isolated function sent with `send_result`.
+
+    Args:
+        receiver (Connection): The pipe end to receive the result from.
+
+    Returns:
+        Any: The result of the function.
+    """
+    is_pickled, payload = receiver.recv()
+    if not is_pickled:
+        return payload
+    pickled_result: bytes = receiver.recv_bytes()
+    buffers: List[bytearray] = []
+    for size in payload:
+        # The out-of-band buffers are received into writable memory so the unpickled objects are not read-only
+        buffer = bytearray(size)
+        receiver.recv_bytes_into(buffer)
+        buffers.append(buffer)
+    return pickle.loads(pickled_result, buffers=buffers)
@@ -1,81 +1,134 @@
-from collections import deque
-from typing import Callable, Tuple
+import inspect
+from functools import lru_cache
+from sys import platform
+from typing import Callable, Dict, Tuple
 
-from multiprocess import Queue  # type: ignore
+# psutil does not support IO counters per process on macOS. Resolved once since it is checked on every sample
+IS_MACOS: bool = platform == "darwin"
+SIZE_UNITS: Tuple[str, ...] = ("B", "KB", "MB", "GB", "TB", "PB")
 
 
 def format_size(bytes_size: int | float) -> str:
     """
     Converts a size in bytes to a human-readable format.
+    Integer sizes, such as the maximum memory or the IO bytes, are cached since they usually repeat for every call of a decorated function.
+    The averages are floats that rarely repeat, so they are formatted without the cache.
     Parameters:
         bytes_size (int | float): The size in bytes to be converted.
     Returns:
-        str: The human-read
+        str: The human-readable size, using petabytes for anything that exceeds terabytes.
     """
-    for unit in ["B", "KB", "MB", "GB", "TB"]:
-        if bytes_size < 1024:
-            if unit == "B":
-                return f"{bytes_size:.0f}{unit}"
-            return f"{bytes_size:.2f}{unit}"
-        bytes_size /= 1024
-    return f"{bytes_size:.2f}PB"  # If it exceeds TB, convert to petabytes
+    if isinstance(bytes_size, int):
+        return _format_int_size(bytes_size)
+    return _format_size(bytes_size)
 
 
-def extract_callable_and_args_if_method(func: Callable, *args: Tuple) -> Tuple[Callable, Tuple, Tuple, bool]:
+@lru_cache(maxsize=1024)
+def _format_int_size(bytes_size: int) -> str:
+    """
+    Cached version of `_format_size` for integer sizes.
+    """
+    return _format_size(bytes_size)
+
+
+def _format_size(bytes_size: int | float) -> str:
+    """
+    Converts a size in bytes to a human-readable format. See `format_size`.
+    """
+    if bytes_size < 1024:
+        return f"{bytes_size:.0f}B"
+    # Every unit is 2^10 times the previous one, so the unit is given by the position of the highest bit
+    unit_index: int = min((int(bytes_size).bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+    return f"{bytes_size / (1 << (10 * unit_index)):.2f}{SIZE_UNITS[unit_index]}"
+
+
+def extract_callable_and_args_if_method(
+    func: Callable, func_name: str, is_classmethod: bool, is_staticmethod: bool, *args: Tuple
+) -> Tuple[Callable, Tuple, Tuple, bool]:
     """
     Extracts the callable function and arguments from a given function, if it is a method.
     Args:
         func (Callable): The function to extract the callable from.
+        func_name (str): The name of the function, computed once at decoration time.
+        is_classmethod (bool): Whether the function is a classmethod, computed once at decoration time.
+        is_staticmethod (bool): Whether the function is a staticmethod, computed once at decoration time.
         *args: Variable length argument list.
     Returns:
-        Tuple[Callable, Tuple, Tuple]: A tuple containing the extracted callable function, the modified arguments,
-        and the arguments to be printed.
+        Tuple[Callable, Tuple, Tuple, bool]: A tuple containing the extracted callable function, the modified arguments,
+        the arguments to be printed and whether the function has been called as a method.
     """
 
     callable_func: Callable = func
     args_to_print: Tuple = args
-    is_method: bool = hasattr(args[0], func.__name__) if args else False
+    is_method: bool = hasattr(args[0], func_name) if args else False
 
     if is_method:
         args_to_print = args[1:]
-        if isinstance(func, classmethod):
+        if is_classmethod:
             args = (args[0].__class__,) + args[1:]  # type: ignore
-            callable_func = func.__func__
-        elif isinstance(func, staticmethod):
+            callable_func = func.__func__  # type: ignore
+        elif is_staticmethod:
             args = args[1:]
     return callable_func, args, args_to_print, is_method
 
 
+def get_code_bytes(func: Callable) -> bytes | None:
+    """
+    Gets the bytecode of a function, unwrapping decorators such as functools.lru_cache that do not expose `__code__`.
+    Args:
+        func (Callable): The function to get the bytecode from.
+    Returns:
+        bytes | None: The bytecode of the function or None if it has no code object.
+    """
+    code = getattr(inspect.unwrap(func), "__code__", None)
+    return code.co_code if code is not None else None
+
+
+def get_func_key(func: Callable) -> Tuple[str, str, bytes | None]:
+    """
+    Gets a key that identifies a function across processes, where its id is not preserved.
+    Args:
+        func (Callable): The function to get the key from.
+    Returns:
+        Tuple[str, str, bytes | None]: The name, the module and the bytecode of the function.
+    """
+    return func.__name__, func.__module__, get_code_bytes(func)
+
+
 def check_is_recursive_func(
-    func: Callable, called_func_stack: deque[Callable], called_isolated_func_queue: Queue
+    func_key: Tuple[str, str, bytes | None],
+    func_id: int,
+    called_func_counter: Dict[int, int],
+    isolated_func_key: Tuple[str, str, bytes | None] | None,
 ) -> bool:
     """
-    Checks if the function is being called recursively by checking the stack of called functions.
-    It will send a warning if the function is being called recursively.
+    Checks if the function is being called recursively by checking the number of active calls of the function.
+    The call is registered in the counter, so it must be released with `release_called_func` once it finishes.
     Args:
-        func (Callable): The function to check for recursion.
-        called_func_stack (deque[Callable]): A stack of potential recursive functions.
+        func_key (Tuple[str, str, bytes | None]): The key of the function to check for recursion, as returned by `get_func_key`.
+        func_id (int): The id of the decorated function, used as the key of the counter.
+        called_func_counter (Dict[int, int]): The number of active calls of each potential recursive function.
+        isolated_func_key (Tuple[str, str, bytes | None] | None): The key of the function run by the current process if it is an isolated process, None otherwise.
     Returns:
         bool: True if the function is being called recursively, False otherwise.
 
     """
-    is_recursive = False
-    if not called_isolated_func_queue.empty():
-
-        prev_func = called_isolated_func_queue.get()
-        called_isolated_func_queue.put(prev_func)
-        if (
-            (prev_func.__name__ == func.__name__)
-            and (prev_func.__module__ == func.__module__)  # noqa: W503
-            and (prev_func.__code__.co_code == func.__code__.co_code)  # noqa: W503
-        ):
-            is_recursive = True
+    active_calls: int = called_func_counter.get(func_id, 0)
+    # The isolated process runs the undecorated function, so its first recursive call is not registered in the counter
+    is_recursive: bool = bool(active_calls) or func_key == isolated_func_key
+    called_func_counter[func_id] = active_calls + 1
+    return is_recursive
 
-    if called_func_stack and called_func_stack[-1] == func:
-        if is_recursive:
-            # This means that it is recursive and it has been called from another process (isolate) so we need to append the same function again
-            called_func_stack.append(func)
-        is_recursive = True
 
-    called_func_stack.append(func)
-    return is_recursive
+def release_called_func(func_id: int, called_func_counter: Dict[int, int]) -> None:
+    """
+    Releases one active call of the function registered by `check_is_recursive_func`.
+    Args:
+        func_id (int): The id of the decorated function, used as the key of the counter.
+        called_func_counter (Dict[int, int]): The number of active calls of each potential recursive function.
+    """
+    active_calls: int = called_func_counter[func_id] - 1
+    if active_calls:
+        called_func_counter[func_id] = active_calls
+    else:
+        del called_func_counter[func_id]
@@ -0,0 +1,42 @@
+import unittest
+
+from metrit.Monitoring import Monitoring
+from metrit.Stats import RawStats
+
+
+def raw_stats_with(cpu_percent, rss_bytes):
+    raw_stats = RawStats()
+    raw_stats.cpu_percent.extend(cpu_percent)
+    raw_stats.rss_bytes.extend(rss_bytes)
+    return raw_stats
+
+
+class TestAdaptRefreshRate(unittest.TestCase):
+    def test_not_enough_samples(self):
+        raw_stats = raw_stats_with([0.0] * 15, [100] * 15)
+        self.assertEqual(Monitoring.adapt_refresh_rate(raw_stats, 0.1, 0.01, 5), 0.1)
+
+    def test_flat_usage_slows_down(self):
+        raw_stats = raw_stats_with([10.0] * 16, [100] * 16)
+        self.assertAlmostEqual(Monitoring.adapt_refresh_rate(raw_stats, 0.1, 0.01, 5), 0.15)
+        self.assertEqual(Monitoring.adapt_refresh_rate(raw_stats, 4, 0.01, 5), 5)
+
+    def test_quantized_busy_usage_slows_down(self):
+        # A single busy thread sampled every 10ms reads as 0, 100 or 200% depending on the scheduler ticks
+        cpu_percent = [100.0, 200.0, 0.0, 100.0, 100.0, 0.0, 200.0, 100.0] * 2
+        raw_stats = raw_stats_with(cpu_percent, [100] * 16)
+        self.assertAlmostEqual(Monitoring.adapt_refresh_rate(raw_stats, 0.1, 0.01, 5), 0.15)
+
+    def test_spike_goes_back_to_min_refresh_rate(self):
+        raw_stats = raw_stats_with([0.0] * 8 + [100.0] * 8, [100] * 16)
+        self.assertEqual(Monitoring.adapt_refresh_rate(raw_stats, 1, 0.01, 5), 0.01)
+        raw_stats = raw_stats_with([10.0] * 16, [100] * 15 + [200])
+        self.assertEqual(Monitoring.adapt_refresh_rate(raw_stats, 1, 0.01, 5), 0.01)
+
+    def test_moderate_changes_keep_refresh_rate(self):
+        raw_stats = raw_stats_with([10.0] * 8 + [40.0] * 8, [100] * 16)
+        self.assertEqual(Monitoring.adapt_refresh_rate(raw_stats, 1, 0.01, 5), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,10 @@
+import io
+import os
+import subprocess
+import sys
 import unittest
+from array import array
+from contextlib import redirect_stdout
 
 from metrit.StatCollector import RawStats, StatCollector, Stats
 
@@ -195,17 +201,113 @@ class TestCalculateStatistics(unittest.TestCase):
         )
         self.assertEqual(self.stat_collector.calculate_statistics(data), expected_stats)
 
+    def test_calculate_statistics_with_array_data(self):
+        data = RawStats()
+        data.cpu_percent.extend([50, 75, 25])
+        data.memory_percent.extend([50, 75, 25])
+        data.rss_bytes.extend([100, 150, 200])
+        data.vms_bytes.extend([100, 150, 200])
+        self.assertIsInstance(data.cpu_percent, array)
+        self.assertIsInstance(data.rss_bytes, array)
+        expected_stats = Stats(
+            cpu_percentage_max=75.0,
+            cpu_percentage_avg=50.0,
+            memory_percentage_avg=50.0,
+            rss_bytes_avg=150.0,
+            rss_bytes_max=200,
+            vms_bytes_avg=150.0,
+            vms_bytes_max=200,
+        )
+        self.assertEqual(self.stat_collector.calculate_statistics(data), expected_stats)
+
+    def test_max_and_mean(self):
+        self.assertEqual(self.stat_collector.max_and_mean(array("d", [0.5, 1.5, 1.0])), (1.5, 1.0))
+        self.assertEqual(self.stat_collector.max_and_mean(array("q", [100, 300])), (300, 200.0))
+        self.assertEqual(self.stat_collector.max_and_mean(array("d")), (0, 0.0))
+
 
 class TestStatCollector(unittest.TestCase):
     def setUp(self):
         self.stat_collector = StatCollector(1)
 
+    def test_get_process_is_cached(self):
+        process = StatCollector.get_process(os.getpid())
+        self.assertEqual(process.pid, os.getpid())
+        self.assertIs(StatCollector.get_process(os.getpid()), process)
+
+    def test_get_pids_without_children(self):
+        stat_collector = StatCollector(os.getpid())
+        self.assertEqual(stat_collector.get_pids(False), [os.getpid()])
+
+    def test_get_pids_with_children(self):
+        child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)"])
+        self.addCleanup(child.wait)
+        self.addCleanup(child.kill)
+        stat_collector = StatCollector(os.getpid())
+        pids = stat_collector.get_pids(True)
+        self.assertEqual(pids[0], os.getpid())
+        self.assertIn(child.pid, pids)
+
+    def test_get_pids_reuses_children_until_expired(self):
+        stat_collector = StatCollector(os.getpid())
+        stat_collector.children_ttl = 60  # Long enough for the children to be reused on a loaded machine
+        self.assertEqual(stat_collector.get_pids(True)[0], os.getpid())
+        child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)"])
+        self.addCleanup(child.wait)
+        self.addCleanup(child.kill)
+        self.assertNotIn(child.pid, stat_collector.get_pids(True))
+        stat_collector.children_expire_time = 0.0
+        self.assertIn(child.pid, stat_collector.get_pids(True))
+
+    def test_collect_stats(self):
+        stat_collector = StatCollector(os.getpid())
+        stats = stat_collector.collect_stats({}, [os.getpid()])
+        self.assertEqual(len(stats[os.getpid()].rss_bytes), 1)
+        self.assertFalse(stat_collector.has_crashed)
+
+    def test_get_cpu_percent_waits_for_cpu_interval(self):
+        stat_collector = StatCollector(1)
+        self.assertIsNone(stat_collector.get_cpu_percent(1, 0.0, 0.0))
+        self.assertIsNone(stat_collector.get_cpu_percent(1, 0.02, 0.01))  # A single 10ms read would report 200%
+        self.assertAlmostEqual(stat_collector.get_cpu_percent(1, 0.1, 0.1), 100.0)
+        self.assertAlmostEqual(stat_collector.get_cpu_percent(1, 0.1, 0.15), 100.0)  # The previous read is repeated
+        self.assertAlmostEqual(stat_collector.get_cpu_percent(1, 0.15, 0.3), 25.0)
+
+    def test_get_cpu_percent_of_short_monitoring(self):
+        stat_collector = StatCollector(1)
+        stat_collector.get_cpu_percent(1, 0.0, 0.0)
+        self.assertAlmostEqual(stat_collector.get_cpu_percent(1, 0.04, 0.05, is_last_sample=True), 80.0)
+
+    def test_collect_stats_fills_samples_before_first_cpu_read(self):
+        stat_collector = StatCollector(os.getpid())
+        stat_collector.cpu_interval = 60
+        stats = stat_collector.collect_stats({}, [os.getpid()])
+        stats = stat_collector.collect_stats(stats, [os.getpid()])
+        self.assertEqual(len(stats[os.getpid()].cpu_percent), 0)
+        stats = stat_collector.collect_stats(stats, [os.getpid()], is_last_sample=True)
+        self.assertEqual(len(stats[os.getpid()].cpu_percent), 3)
+        self.assertEqual(len(set(stats[os.getpid()].cpu_percent)), 1)
+
+    def test_collect_stats_of_finished_process(self):
+        child = subprocess.Popen([sys.executable, "-c", "pass"])
+        child.wait()
+        stat_collector = StatCollector(child.pid)
+        with redirect_stdout(io.StringIO()):
+            stat_collector.collect_stats({}, [child.pid])
+        self.assertTrue(stat_collector.has_crashed)
+
     def test_subtract_stats_with_empty_dicts(self):
         main = {}
         other = {}
         result = StatCollector.subtract_stats(main, other)
         self.assertEqual(result, {})
 
+    def test_subtract_stats_with_empty_other(self):
+        main = {1: Stats(rss_bytes_avg=1000, rss_bytes_max=2000)}
+        result = StatCollector.subtract_stats(main, {})
+        self.assertEqual(result, main)
+        self.assertIsNot(result, main)
+
     def test_get_final_stats_single(self):
         stats = {
             1: Stats(
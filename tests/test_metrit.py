@@ -1,8 +1,13 @@
+import io
 import os
+import re
+import threading
 import unittest
-from time import sleep
+from contextlib import redirect_stderr, redirect_stdout
+from functools import lru_cache
+from time import monotonic, sleep
 
-from metrit.core import MetritConfig, metrit
+from metrit.core import MetritConfig, get_mp_context, metrit
 
 IN_GITHUB_ACTIONS = os.getenv("GITHUB_ACTIONS") == "true"
 
@@ -56,6 +61,14 @@ def recursive_func(n):
     return recursive_func(n - 2) + recursive_func(n - 1)
 
 
+@metrit
+@lru_cache(maxsize=None)
+def memoized_recursive_func(n):
+    if n < 2:
+        return n
+    return memoized_recursive_func(n - 2) + memoized_recursive_func(n - 1)
+
+
 def fib(n):
     if n < 2:
         return n
@@ -80,6 +93,73 @@ def simulate_writes_and_reads(num_writes=5_000, data_size=1024):
     os.remove(file)
 
 
+@metrit
+def large_result(size):
+    return b"a" * size
+
+
+@metrit
+def bytearray_result(size):
+    return bytearray(size)
+
+
+@metrit
+def lambda_result():
+    return lambda x: x + 1
+
+
+@metrit(isolate=False)
+def raise_if_negative(n):
+    if n < 0:
+        raise ValueError("n must not be negative")
+    return n
+
+
+def spin(duration_in_seconds):
+    start = monotonic()
+    while monotonic() - start < duration_in_seconds:
+        pass  # Keep a single core busy
+
+
+@metrit(verbose=True)
+def short_spin_isolated():
+    spin(0.003)  # Shorter than the 5ms switch interval of the GIL, so the monitor thread doesn't run before it returns
+
+
+@metrit(isolate=False, verbose=True)
+def short_spin():
+    spin(0.003)
+
+
+@metrit(isolate=False, verbose=True)
+def nested_spin_inner():
+    spin(0.5)
+
+
+@metrit(isolate=False, verbose=True)
+def nested_spin_outer():
+    nested_spin_inner()
+    spin(0.3)
+
+
+concurrent_barrier = threading.Barrier(2, timeout=10)
+
+
+@metrit(isolate=False)
+def wait_for_concurrent_call():
+    concurrent_barrier.wait()  # Both threads are inside the decorated function at the same time
+
+
+@metrit(isolate=False)
+def call_isolated_from_non_isolated():
+    return cpu_intensive(3, 4)  # Started while the monitor thread of this call is running
+
+
+@metrit
+def sum_values(values):
+    return sum(values)
+
+
 class TestMetritFunctions(unittest.TestCase):
     def setUp(self):
         MetritConfig.ACTIVE = True
@@ -115,6 +195,10 @@ class TestMetritFunctions(unittest.TestCase):
         result = recursive_func(5)
         self.assertEqual(result, 5)  # fib(5) is 5
 
+    def test_memoized_recursive_func(self):
+        result = memoized_recursive_func(21)
+        self.assertEqual(result, 10946)  # fib(21) is 10946
+
     def test_wrapped_recursive_func(self):
         result = wrapped_recursive_func(5)
         self.assertEqual(result, 5)  # fib(5) is 5
@@ -122,6 +206,106 @@ class TestMetritFunctions(unittest.TestCase):
     def test_simulate_writes_and_reads(self):
         simulate_writes_and_reads(100, 1024)  # Smaller number of writes for testing purposes
 
+    def test_deactivated_at_runtime(self):
+        MetritConfig.ACTIVE = False
+        self.addCleanup(setattr, MetritConfig, "ACTIVE", True)
+        obj = MetritTestClass()
+        output = io.StringIO()
+        with redirect_stdout(output):
+            result = cpu_intensive(3, b=4)
+            class_name, class_result = obj.class_method(3, b=4)
+            static_result = MetritTestClass.static_method()
+        self.assertEqual(result, 7)
+        self.assertEqual(class_name, "MetritTestClass")
+        self.assertEqual(class_result, 7)
+        self.assertEqual(static_result, 3)
+        self.assertEqual(output.getvalue(), "")
+
+    def test_large_result(self):
+        result = large_result(1024 * 1024)  # Larger than the pipe buffer used to send it back from the isolated process
+        self.assertEqual(len(result), 1024 * 1024)
+
+    def test_bytearray_result(self):
+        result = bytearray_result(1024 * 1024)  # Sent out-of-band from the isolated process
+        result[0] = 1
+        self.assertEqual(len(result), 1024 * 1024)
+
+    def test_lambda_result(self):
+        self.assertEqual(lambda_result()(1), 2)  # Only dill can send it back from the isolated process
+
+    def test_call_after_exception_is_not_recursive(self):
+        with redirect_stderr(io.StringIO()), self.assertRaises(ValueError):
+            raise_if_negative(-1)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            result = raise_if_negative(1)
+        self.assertEqual(result, 1)
+        self.assertIn("'raise_if_negative'", output.getvalue())
+
+    def test_nested_calls_measure_cpu_independently(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            nested_spin_outer()
+        max_cpu = [float(value) for value in re.findall(r"Maximum CPU usage: ([\d.]+)%", output.getvalue())]
+        avg_cpu = [float(value) for value in re.findall(r"Average CPU usage: ([\d.]+)%", output.getvalue())]
+        self.assertEqual(len(max_cpu), 2)
+        self.assertEqual(len(avg_cpu), 2)
+        # A single busy thread can't use more than one core, give or take the resolution of the CPU times
+        for value in max_cpu:
+            self.assertLess(value, 150)
+        for value in avg_cpu:
+            self.assertLess(value, 120)
+
+    def test_concurrent_calls_are_not_recursive(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            threads = [threading.Thread(target=wait_for_concurrent_call) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertFalse(concurrent_barrier.broken)
+        self.assertEqual(output.getvalue().count("'wait_for_concurrent_call'"), 2)
+
+    def test_isolated_call_inside_non_isolated_call(self):
+        with redirect_stdout(io.StringIO()):
+            result = call_isolated_from_non_isolated()
+        self.assertEqual(result, 7)
+
+    def test_mp_context_does_not_fork_with_running_threads(self):
+        stop_event = threading.Event()
+        thread = threading.Thread(target=stop_event.wait)
+        thread.start()
+        try:
+            self.assertNotEqual(get_mp_context().get_start_method(), "fork")
+        finally:
+            stop_event.set()
+            thread.join()
+
+    def test_unpicklable_argument_with_running_threads(self):
+        stop_event = threading.Event()
+        thread = threading.Thread(target=stop_event.wait)
+        thread.start()
+        output = io.StringIO()
+        try:
+            with redirect_stdout(output):
+                result = sum_values(value for value in range(4))  # Generators can't be sent to the forkserver process
+        finally:
+            stop_event.set()
+            thread.join()
+        self.assertEqual(result, 6)
+        self.assertIn("Trying it again in main process", output.getvalue())
+
+    def test_short_busy_function_uses_cpu(self):
+        for func in (short_spin, short_spin_isolated):
+            output = io.StringIO()
+            with redirect_stdout(output):
+                func()
+            max_cpu = float(re.search(r"Maximum CPU usage: ([\d.]+)%", output.getvalue()).group(1))
+            avg_cpu = float(re.search(r"Average CPU usage: ([\d.]+)%", output.getvalue()).group(1))
+            self.assertGreater(max_cpu, 0)
+            self.assertGreater(avg_cpu, 0)
+
 
 if __name__ == "__main__":
     unittest.main()
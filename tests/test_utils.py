@@ -1,6 +1,6 @@
 import unittest
 
-from metrit.utils import format_size
+from metrit.utils import _format_int_size, format_size
 
 
 class TestFormatSize(unittest.TestCase):
@@ -23,6 +23,20 @@ class TestFormatSize(unittest.TestCase):
     def test_petabytes(self):
         self.assertEqual(format_size(1024 * 1024 * 1024 * 1024 * 1024), "1.00PB")
 
+    def test_unit_boundaries(self):
+        self.assertEqual(format_size(1023.4), "1023B")
+        self.assertEqual(format_size(1024 * 1024 - 1), "1024.00KB")
+        self.assertEqual(format_size(1536.0), "1.50KB")
+        self.assertEqual(format_size(1024 * 1024 * 1024 * 1024 * 1024 * 2048), "2048.00PB")
+
+    def test_only_integer_sizes_are_cached(self):
+        _format_int_size.cache_clear()
+        self.assertEqual(format_size(2048), "2.00KB")
+        self.assertEqual(format_size(2048), "2.00KB")
+        self.assertEqual(format_size(2048.5), "2.00KB")
+        cache_info = _format_int_size.cache_info()
+        self.assertEqual((cache_info.hits, cache_info.misses), (1, 1))
+
 
 if __name__ == "__main__":
     unittest.main()